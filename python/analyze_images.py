@@ -3,53 +3,199 @@
 Analyze current images in the project to identify optimization opportunities
 """
 
+import json
 import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, List, Tuple
+from typing import Dict, List, NamedTuple, Optional, Tuple
 
 import click
+import numpy as np
 from PIL import Image
 from tqdm import tqdm
 
+from image_utils import walk_images
+
 
 # Project root directory
 PROJECT_ROOT = Path(__file__).parent.parent
 IMAGES_DIR = PROJECT_ROOT / "workspaces" / "server" / "seeds" / "images"
+# Analysis results from previous runs, keyed by absolute path
+CACHE_FILE = PROJECT_ROOT / "python" / ".analyze_cache.json"
+
+# Columns used for the summary reductions in main()
+IMAGE_INFO_DTYPE = [
+    ('size', 'i8'),
+    ('width', 'i4'),
+    ('height', 'i4'),
+    ('format', 'U16'),
+    ('mode', 'U16'),
+]
+
+# Bytes read up front; enough for PNG, GIF and WebP dimensions
+HEADER_READ_SIZE = 32
+# Extra bytes scanned for the JPEG SOF marker, which follows APPn (EXIF, ICC) segments
+JPEG_SCAN_SIZE = 64 * 1024
+
+PNG_MODES = {(0, 8): 'L', (2, 8): 'RGB', (3, 8): 'P', (4, 8): 'LA', (6, 8): 'RGBA'}
+JPEG_MODES = {1: 'L', 3: 'RGB', 4: 'CMYK'}
+# SOFn markers, excluding DHT (C4), JPG (C8) and DAC (CC)
+JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+class ImageInfo(NamedTuple):
+    """Information about an image file"""
+    path: Path
+    name: str
+    size: int
+    width: int
+    height: int
+    format: Optional[str]
+    mode: str
+    
+    @property
+    def size_mb(self) -> float:
+        return self.size / 1024 / 1024
+
 
+def parse_image_header(buf: bytes) -> Optional[Tuple[int, int, str, str]]:
+    """
+    Parse (width, height, format, mode) from the leading bytes of an image file
+    Returns None for unsupported formats or modes, or if buf is too short
+    GIF mode is approximate: always P, even for grayscale palettes Pillow opens as L
+    """
+    if buf.startswith(b'\x89PNG\r\n\x1a\n') and buf[12:16] == b'IHDR' and len(buf) >= 26:
+        width, height, bit_depth, color_type = struct.unpack('>IIBB', buf[16:26])
+        mode = PNG_MODES.get((color_type, bit_depth))
+        return (width, height, 'PNG', mode) if mode else None
+    
+    if buf[:6] in (b'GIF87a', b'GIF89a') and len(buf) >= 10:
+        width, height = struct.unpack('<HH', buf[6:10])
+        return width, height, 'GIF', 'P'
+    
+    if buf[:4] == b'RIFF' and buf[8:12] == b'WEBP' and len(buf) >= 30:
+        chunk = buf[12:16]
+        if chunk == b'VP8 ' and buf[23:26] == b'\x9d\x01\x2a':
+            width, height = struct.unpack('<HH', buf[26:30])
+            return width & 0x3FFF, height & 0x3FFF, 'WEBP', 'RGB'
+        if chunk == b'VP8L' and buf[20] == 0x2F:
+            bits = int.from_bytes(buf[21:25], 'little')
+            alpha = (bits >> 28) & 1
+            return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1, 'WEBP', 'RGBA' if alpha else 'RGB'
+        if chunk == b'VP8X':
+            alpha = buf[20] & 0x10
+            width = int.from_bytes(buf[24:27], 'little') + 1
+            height = int.from_bytes(buf[27:30], 'little') + 1
+            return width, height, 'WEBP', 'RGBA' if alpha else 'RGB'
+        return None
+    
+    if buf[:3] == b'\xff\xd8\xff':
+        # Walk marker segments until the frame header
+        pos = 2
+        while pos + 4 <= len(buf):
+            if buf[pos] != 0xFF:
+                return None
+            marker = buf[pos + 1]
+            if marker == 0xFF:  # fill byte
+                pos += 1
+                continue
+            if marker in JPEG_SOF_MARKERS:
+                if pos + 10 > len(buf):
+                    return None
+                height, width, components = struct.unpack('>HHB', buf[pos + 5:pos + 10])
+                mode = JPEG_MODES.get(components)
+                return (width, height, 'JPEG', mode) if mode else None
+            pos += 2 + struct.unpack('>H', buf[pos + 2:pos + 4])[0]
+        return None
+    
+    return None
 
-def get_image_info(file_path: Path) -> Dict:
-    """Get information about an image file"""
+
+def read_image_header(file_path: Path) -> Optional[Tuple[int, int, str, str]]:
+    """Read (width, height, format, mode) from the file header without decoding"""
+    with open(file_path, 'rb') as f:
+        buf = f.read(HEADER_READ_SIZE)
+        header = parse_image_header(buf)
+        if header is None and buf[:3] == b'\xff\xd8\xff':
+            buf += f.read(JPEG_SCAN_SIZE)
+            header = parse_image_header(buf)
+    return header
+
+
+def get_image_info(
+    file_path: Path,
+    name: Optional[str] = None,
+    st: Optional[os.stat_result] = None
+) -> Optional[ImageInfo]:
+    """
+    Get information about an image file, reusing a pre-fetched name and stat if given
+    Returns None if the file can't be read as an image
+    """
     try:
-        size = file_path.stat().st_size
-        with Image.open(file_path) as img:
-            width, height = img.size
-            format = img.format
-            mode = img.mode
+        size = (st or file_path.stat()).st_size
+        header = read_image_header(file_path)
+        if header:
+            width, height, format, mode = header
+        else:
+            # Fall back to Pillow for formats the header reader doesn't handle
+            with Image.open(file_path) as img:
+                width, height = img.size
+                format = img.format
+                mode = img.mode
         
-        return {
-            'path': file_path,
-            'size': size,
-            'width': width,
-            'height': height,
-            'format': format,
-            'mode': mode,
-            'size_mb': size / 1024 / 1024
-        }
-    except Exception as e:
-        return {
-            'path': file_path,
-            'error': str(e)
-        }
-
-
-def get_all_images(directory: Path) -> List[Path]:
-    """Get all image files from directory"""
-    image_extensions = {'.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp', '.svg'}
-    images = []
-    for ext in image_extensions:
-        images.extend(directory.rglob(f"*{ext}"))
-        images.extend(directory.rglob(f"*{ext.upper()}"))
-    return sorted(set(images))
+        return ImageInfo(file_path, name or file_path.name, size, width, height, format, mode)
+    except Exception:
+        return None
+
+
+def get_all_images(directory: Path) -> List[Tuple[Path, str, os.stat_result]]:
+    """Get all image files from directory along with their names and stat results"""
+    image_extensions = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp', '.svg')
+    return sorted(walk_images(directory, image_extensions), key=lambda x: x[0])
+
+
+def load_cache(cache_file: Path) -> Dict:
+    """Load cached analysis results, or an empty cache if missing or unreadable"""
+    try:
+        return json.loads(cache_file.read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(cache_file: Path, cache: Dict):
+    """Write cached analysis results, replacing the file atomically"""
+    tmp_file = cache_file.with_name(cache_file.name + ".tmp")
+    tmp_file.write_text(json.dumps(cache))
+    os.replace(tmp_file, cache_file)
+
+
+def get_cached_info(entry: Optional[Dict], file_path: Path, name: str,
+                    st: os.stat_result) -> Tuple[bool, Optional[ImageInfo]]:
+    """
+    Look up a cache entry, valid only if the file's mtime and size are unchanged
+    Returns (hit, info); info is None for files previously found unreadable
+    """
+    if entry is None or entry['mtime_ns'] != st.st_mtime_ns or entry['size'] != st.st_size:
+        return False, None
+    if entry.get('error'):
+        return True, None
+    return True, ImageInfo(file_path, name, entry['size'], entry['width'], entry['height'],
+                           entry['format'], entry['mode'])
+
+
+def make_cache_entry(info: Optional[ImageInfo], st: os.stat_result) -> Dict:
+    """Build a cache entry for an analyzed file"""
+    if info is None:
+        return {'mtime_ns': st.st_mtime_ns, 'size': st.st_size, 'error': True}
+    return {
+        'mtime_ns': st.st_mtime_ns,
+        'size': st.st_size,
+        'width': info.width,
+        'height': info.height,
+        'format': info.format,
+        'mode': info.mode,
+    }
 
 
 @click.command()
@@ -58,7 +204,10 @@ def get_all_images(directory: Path) -> List[Path]:
 @click.option('--min-size', default=0.5, help='Minimum file size in MB to report')
 @click.option('--sort-by', type=click.Choice(['size', 'name', 'format']), 
               default='size', help='Sort results by')
-def main(input_dir, min_size, sort_by):
+@click.option('--io-depth', type=click.IntRange(min=1), default=64,
+              help='Number of header reads kept in flight')
+@click.option('--no-cache', is_flag=True, help='Re-read every image instead of using cached results')
+def main(input_dir, min_size, sort_by, io_depth, no_cache):
     """Analyze images and identify optimization opportunities"""
     
     # Set directory
@@ -77,25 +226,68 @@ def main(input_dir, min_size, sort_by):
         click.echo("No image files found")
         return
     
-    # Analyze images
-    image_infos = []
-    total_size = 0
+    # Reuse results for files whose mtime and size haven't changed
+    cache = {} if no_cache else load_cache(CACHE_FILE)
+    keys = [os.path.abspath(img_path) for img_path, _, _ in image_files]
+    infos: List[Optional[ImageInfo]] = [None] * len(image_files)
+    misses = []
+    for i, ((img_path, name, st), key) in enumerate(zip(image_files, keys)):
+        hit, infos[i] = get_cached_info(cache.get(key), img_path, name, st)
+        if not hit:
+            misses.append(i)
+    
+    # Analyze remaining images, keeping many header reads in flight so the kernel
+    # can queue them to the device together (file reads release the GIL)
+    with ThreadPoolExecutor(max_workers=io_depth) as executor:
+        results = executor.map(lambda i: get_image_info(*image_files[i]), misses)
+        with tqdm(zip(misses, results), total=len(misses), desc="Analyzing images") as pbar:
+            for n, (i, info) in enumerate(pbar):
+                # Redrawing the description is a terminal write, so only do it periodically
+                if n % 100 == 0:
+                    pbar.set_description(f"Analyzing {image_files[i][1]}")
+                infos[i] = info
+                cache[keys[i]] = make_cache_entry(info, image_files[i][2])
+    
+    if not no_cache:
+        # Drop entries for files under this directory that no longer exist
+        prefix = os.path.join(os.path.abspath(images_dir), '')
+        current = set(keys)
+        stale = [k for k in cache if k.startswith(prefix) and k not in current]
+        for k in stale:
+            del cache[k]
+        if misses or stale:
+            save_cache(CACHE_FILE, cache)
     
-    with tqdm(image_files, desc="Analyzing images") as pbar:
-        for img_path in pbar:
-            pbar.set_description(f"Analyzing {img_path.name}")
-            info = get_image_info(img_path)
-            if 'error' not in info:
-                image_infos.append(info)
-                total_size += info['size']
+    image_infos = [info for info in infos if info is not None]
     
-    # Sort results
+    # Build a structured array so reductions below run in NumPy rather than per-dict
+    arr = np.array(
+        [(info.size, info.width, info.height, info.format or 'Unknown', info.mode)
+         for info in image_infos],
+        dtype=IMAGE_INFO_DTYPE
+    )
+    size_mb = arr['size'] / 1024 / 1024
+    total_size = int(arr['size'].sum())
+    
+    # Classify every image in one place. Format and mode predicates are evaluated
+    # once per distinct value, then broadcast back to images via the unique index
+    formats, format_index, format_counts = np.unique(
+        arr['format'], return_inverse=True, return_counts=True)
+    modes, mode_index = np.unique(arr['mode'], return_inverse=True)
+    format_sizes = np.bincount(format_index, weights=arr['size'], minlength=len(formats))
+    
+    png_photos = (formats == 'PNG')[format_index] & np.isin(modes, ['RGB', 'RGBA'])[mode_index]
+    oversized = (arr['width'] > 2048) | (arr['height'] > 2048)
+    old_formats = np.isin(formats, ['BMP', 'TIFF'])[format_index]
+    
+    # Sort results (stable, ties keep discovery order like list.sort)
     if sort_by == 'size':
-        image_infos.sort(key=lambda x: x['size'], reverse=True)
+        order = np.argsort(-arr['size'], kind='stable')
     elif sort_by == 'name':
-        image_infos.sort(key=lambda x: x['path'].name)
+        names = np.array([info.name for info in image_infos], dtype=str)
+        order = np.argsort(names, kind='stable')
     elif sort_by == 'format':
-        image_infos.sort(key=lambda x: (x['format'], x['size']), reverse=True)
+        order = np.lexsort((-np.arange(len(arr)), arr['size'], arr['format']))[::-1]
     
     # Print summary
     click.echo(f"\nTotal images: {len(image_infos)}")
@@ -103,32 +295,25 @@ def main(input_dir, min_size, sort_by):
     click.echo("")
     
     # Print format distribution
-    format_stats = {}
-    for info in image_infos:
-        fmt = info['format'] or 'Unknown'
-        if fmt not in format_stats:
-            format_stats[fmt] = {'count': 0, 'size': 0}
-        format_stats[fmt]['count'] += 1
-        format_stats[fmt]['size'] += info['size']
-    
     click.echo("Format distribution:")
     click.echo("-" * 40)
-    for fmt, stats in sorted(format_stats.items()):
-        click.echo(f"{fmt:10} {stats['count']:4} files, {stats['size'] / 1024 / 1024:8.2f} MB")
+    for fmt, count, fmt_size in zip(formats, format_counts, format_sizes):
+        click.echo(f"{fmt:10} {count:4} files, {fmt_size / 1024 / 1024:8.2f} MB")
     click.echo("")
     
     # Print large images
-    large_images = [img for img in image_infos if img['size_mb'] >= min_size]
-    if large_images:
+    large_images = order[size_mb[order] >= min_size]
+    if len(large_images):
         click.echo(f"\nImages larger than {min_size} MB:")
         click.echo("-" * 80)
         click.echo(f"{'Filename':<30} {'Format':<8} {'Size (MB)':<10} {'Dimensions':<15} {'Mode':<8}")
         click.echo("-" * 80)
         
-        for info in large_images[:20]:  # Show top 20
-            filename = info['path'].name[:29]
-            dimensions = f"{info['width']}x{info['height']}"
-            click.echo(f"{filename:<30} {info['format']:<8} {info['size_mb']:>9.2f} {dimensions:<15} {info['mode']:<8}")
+        for i in large_images[:20]:  # Show top 20
+            info = image_infos[i]
+            filename = info.name[:29]
+            dimensions = f"{info.width}x{info.height}"
+            click.echo(f"{filename:<30} {arr['format'][i]:<8} {info.size_mb:>9.2f} {dimensions:<15} {info.mode:<8}")
         
         if len(large_images) > 20:
             click.echo(f"\n... and {len(large_images) - 20} more images")
@@ -139,23 +324,17 @@ def main(input_dir, min_size, sort_by):
     click.echo("-" * 60)
     
     # PNG files that could be JPEG
-    png_photos = [img for img in image_infos 
-                  if img.get('format') == 'PNG' and img.get('mode') in ['RGB', 'RGBA']]
-    if png_photos:
-        png_size = sum(img['size'] for img in png_photos) / 1024 / 1024
-        click.echo(f"- {len(png_photos)} PNG files ({png_size:.1f} MB) could potentially be converted to JPEG/WebP")
+    if png_photos.any():
+        png_size = size_mb[png_photos].sum()
+        click.echo(f"- {png_photos.sum()} PNG files ({png_size:.1f} MB) could potentially be converted to JPEG/WebP")
     
     # Large dimensions
-    oversized = [img for img in image_infos 
-                 if img.get('width', 0) > 2048 or img.get('height', 0) > 2048]
-    if oversized:
-        click.echo(f"- {len(oversized)} images have dimensions larger than 2048px")
+    if oversized.any():
+        click.echo(f"- {oversized.sum()} images have dimensions larger than 2048px")
     
     # Old formats
-    old_formats = [img for img in image_infos 
-                   if img.get('format') in ['BMP', 'TIFF']]
-    if old_formats:
-        click.echo(f"- {len(old_formats)} images use old formats (BMP, TIFF)")
+    if old_formats.any():
+        click.echo(f"- {old_formats.sum()} images use old formats (BMP, TIFF)")
     
     click.echo("")
 
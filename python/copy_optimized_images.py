@@ -5,17 +5,49 @@ Preserves original filenames and adds WebP variants
 """
 
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Optional, Tuple
 
 import click
 from tqdm import tqdm
 
+from image_utils import META_SUFFIX
+
 
 # Project root directory
 PROJECT_ROOT = Path(__file__).parent.parent
 OUTPUT_DIR = PROJECT_ROOT / "python" / "output"
 TARGET_DIR = PROJECT_ROOT / "workspaces" / "server" / "seeds" / "images"
 
+# Concurrent copies, keeps several I/O requests in flight
+COPY_WORKERS = 8
+
+
+def is_up_to_date(src: Path, dst: Path) -> bool:
+    """Check whether dst is already an identical copy of src (copy2 preserves mtime)"""
+    try:
+        src_stat = src.stat()
+        dst_stat = dst.stat()
+    except OSError:
+        return False
+    return (src_stat.st_size == dst_stat.st_size
+            and src_stat.st_mtime_ns == dst_stat.st_mtime_ns)
+
+
+def copy_file(paths: Tuple[Path, Path]) -> Optional[Exception]:
+    """
+    Copy src to dst with shutil.copy2 (in-kernel sendfile on Linux), preserving
+    permissions and timestamps
+    Returns the exception on failure so errors can be reported from the main thread
+    """
+    src, dst = paths
+    try:
+        shutil.copy2(src, dst)
+    except Exception as e:
+        return e
+    return None
+
 
 @click.command()
 @click.option('--dry-run', is_flag=True, help='Show what would be copied without actually copying')
@@ -37,7 +69,7 @@ def main(dry_run, webp_only):
         files_to_copy = [(f, TARGET_DIR / f.name) for f in webp_files]
     else:
         # All optimized files
-        all_files = list(OUTPUT_DIR.glob("*.*"))
+        all_files = [f for f in OUTPUT_DIR.glob("*.*") if not f.name.endswith(META_SUFFIX)]
         files_to_copy = [(f, TARGET_DIR / f.name) for f in all_files]
     
     if not files_to_copy:
@@ -56,18 +88,22 @@ def main(dry_run, webp_only):
             click.echo(f"  ... and {len(files_to_copy) - 10} more files")
         return
     
-    # Copy files
+    # Copy files that changed, several at a time
+    pending = [(src, dst) for src, dst in files_to_copy if not is_up_to_date(src, dst)]
+    skipped = len(files_to_copy) - len(pending)
     copied = 0
-    with tqdm(files_to_copy, desc="Copying files") as pbar:
-        for src, dst in pbar:
-            pbar.set_description(f"Copying {src.name}")
-            try:
-                shutil.copy2(src, dst)
+    
+    with ThreadPoolExecutor(max_workers=COPY_WORKERS) as executor:
+        results = executor.map(copy_file, pending)
+        for (src, _), error in tqdm(zip(pending, results), total=len(pending), desc="Copying files"):
+            if error is None:
                 copied += 1
-            except Exception as e:
-                click.echo(f"\nError copying {src.name}: {e}", err=True)
+            else:
+                click.echo(f"\nError copying {src.name}: {error}", err=True)
     
     click.echo(f"\nSuccessfully copied {copied} files to {TARGET_DIR}")
+    if skipped:
+        click.echo(f"Skipped {skipped} files that were already up to date")
 
 
 if __name__ == "__main__":
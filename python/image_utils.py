@@ -0,0 +1,27 @@
+"""
+Helpers shared by the image analysis, optimization and copy scripts
+"""
+
+import os
+from pathlib import Path
+from typing import Iterator, Tuple
+
+
+# Sidecar file written next to each output by optimize_images.py, recording the
+# parameters it was encoded with; never copied to the server
+META_SUFFIX = ".opt-meta.json"
+
+
+def walk_images(root: Path, extensions: Tuple[str, ...]) -> Iterator[Tuple[Path, str, os.stat_result]]:
+    """
+    Walk directory tree once with os.scandir, yielding (path, name, stat) for image files
+    Extensions must be lowercase and include the leading dot
+    """
+    stack = [str(root)]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file() and entry.name.lower().endswith(extensions):
+                    yield Path(entry.path), entry.name, entry.stat()
@@ -4,32 +4,253 @@ Image optimization script for Web Speed Hackathon 2024
 Optimizes images by converting to modern formats and reducing file sizes
 """
 
+import io
+import json
+import mmap
 import os
 import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import List, Tuple
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
 
 import click
+import numpy as np
 from PIL import Image
 from tqdm import tqdm
 
-# Enable AVIF support if available
+from image_utils import META_SUFFIX, walk_images
+
+# Enable AVIF support if available (pillow-avif-plugin registers itself on import)
 try:
-    import pillow_avif_plugin
+    import pillow_avif
     AVIF_SUPPORT = True
 except ImportError:
     AVIF_SUPPORT = False
 
+# Use a JIT-compiled alpha composite if numba is available
+try:
+    import numba
+    NUMBA_SUPPORT = True
+except ImportError:
+    NUMBA_SUPPORT = False
+
+# Optional multi-threaded SIMD resize backends
+try:
+    import cv2
+    CV2_SUPPORT = True
+except ImportError:
+    CV2_SUPPORT = False
+
+try:
+    import pyvips
+    VIPS_SUPPORT = True
+except (ImportError, OSError):  # pyvips raises OSError when libvips is missing
+    VIPS_SUPPORT = False
+
+RESIZERS = {'pil': True, 'cv2': CV2_SUPPORT, 'vips': VIPS_SUPPORT}
+
+DEFAULT_FORMATS = ['webp', 'avif', 'original']
+
+# WebP method used when --webp-method isn't given; images up to SMALL_IMAGE_PIXELS
+# are cheap enough to encode with method 6 instead
+DEFAULT_WEBP_METHOD = 4
+SMALL_IMAGE_PIXELS = 256 * 256
+
+# Inputs are trusted seed images, skip Pillow's decompression bomb check
+Image.MAX_IMAGE_PIXELS = None
+
 # Project root directory
 PROJECT_ROOT = Path(__file__).parent.parent
 IMAGES_DIR = PROJECT_ROOT / "workspaces" / "server" / "seeds" / "images"
 OUTPUT_DIR = PROJECT_ROOT / "python" / "output"
 
+# Inputs larger than this are memory-mapped instead of read through a buffered file
+MMAP_THRESHOLD = 512 * 1024
+
+# Output directories already created by this process
+CREATED_DIRS: Set[Path] = set()
+
+def get_image_files(directory: Path) -> List[Tuple[Path, str, os.stat_result]]:
+    """Get all image files from directory along with their names and stat results"""
+    image_extensions = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp')
+    return list(walk_images(directory, image_extensions))
+
+
+class OutputFile(NamedTuple):
+    """An optimized output; webp_method is set for WebP files encoded in this run"""
+    path: Path
+    size: int
+    webp_method: Optional[int] = None
 
-def get_image_files(directory: Path) -> List[Path]:
-    """Get all image files from directory"""
-    image_extensions = {'.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp'}
-    return [f for f in directory.rglob("*") if f.suffix.lower() in image_extensions]
+
+def get_output_path(fmt: str, file_output_dir: Path, relative_path: Path) -> Path:
+    """Get the output path for a given format"""
+    if fmt == 'original':
+        return file_output_dir / relative_path.name
+    return file_output_dir / f"{relative_path.stem}.{fmt}"
+
+
+def get_output_formats(file_output_dir: Path, relative_path: Path, formats: List[str]) -> Dict[Path, str]:
+    """
+    Map each output path to the format that writes it
+    Formats that map to the same file (e.g. 'webp' and 'original' for a .webp
+    input) would overwrite each other; the last one is kept, as serial encoding did
+    """
+    return {get_output_path(fmt, file_output_dir, relative_path): fmt for fmt in formats}
+
+
+def get_cached_size(output_path: Path, input_mtime: float, params: Dict) -> Optional[int]:
+    """
+    Return the size of an existing output if it is up to date
+    (newer than the input and encoded from it with the same parameters), else None
+    """
+    try:
+        st = output_path.stat()
+        if st.st_mtime < input_mtime:
+            return None
+        meta_path = output_path.with_name(output_path.name + META_SUFFIX)
+        if json.loads(meta_path.read_text()) != params:
+            return None
+    except (OSError, ValueError):
+        return None
+    return st.st_size
+
+
+def write_file(path: Path, data: memoryview) -> int:
+    """
+    Write an encoded buffer to disk with as few write syscalls as possible
+    Writes to a temp file in the same directory and renames it into place, so an
+    interrupted write never leaves a truncated file and concurrent writers of the
+    same path never interleave
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        try:
+            written = 0
+            while written < len(data):
+                written += os.write(fd, data[written:])
+        finally:
+            os.close(fd)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return len(data)
+
+
+def write_meta(output_path: Path, params: Dict):
+    """Record the parameters an output was encoded with, once the output is in place"""
+    meta_path = output_path.with_name(output_path.name + META_SUFFIX)
+    write_file(meta_path, memoryview(json.dumps(params).encode()))
+
+
+if NUMBA_SUPPORT:
+    @numba.njit(parallel=True, cache=True)
+    def flatten_rgba_kernel(rgba, out):
+        """Fused per-pixel composite of rgba onto white, written into out"""
+        height, width, _ = rgba.shape
+        for y in numba.prange(height):
+            for x in range(width):
+                a = np.int32(rgba[y, x, 3])
+                for c in range(3):
+                    out[y, x, c] = (np.int32(rgba[y, x, c]) * a + 255 * (255 - a) + 127) // 255
+
+
+def flatten_alpha(img: Image.Image) -> Image.Image:
+    """
+    Composite an RGBA image onto a white background in a single pass
+    Matches Image.paste(img, mask=alpha) rounding exactly
+    """
+    rgba = np.asarray(img)
+    if NUMBA_SUPPORT:
+        rgb = np.empty(rgba.shape[:2] + (3,), dtype=np.uint8)
+        flatten_rgba_kernel(rgba, rgb)
+    else:
+        alpha = rgba[:, :, 3:].astype(np.uint16)
+        rgb = ((rgba[:, :, :3] * alpha + 255 * (255 - alpha) + 127) // 255).astype(np.uint8)
+    return Image.fromarray(rgb, 'RGB')
+
+
+def resize_image(img: Image.Image, size: Tuple[int, int], resizer: str = 'pil') -> Image.Image:
+    """
+    Downscale an image with the selected backend
+    cv2 uses area averaging (INTER_AREA); vips uses its default lanczos3 kernel,
+    multi-threaded; pil and modes other than L/RGB/RGBA use Pillow LANCZOS
+    """
+    if resizer == 'pil' or img.mode not in ('L', 'RGB', 'RGBA'):
+        return img.resize(size, Image.Resampling.LANCZOS)
+    
+    arr = np.asarray(img)
+    if resizer == 'cv2':
+        # Channel order doesn't matter for area averaging, so no RGB/BGR swap is needed
+        resized = cv2.resize(arr, size, interpolation=cv2.INTER_AREA)
+    elif resizer == 'vips':
+        # resize() rounds its own output size; force exactly size like the other backends
+        vimg = pyvips.Image.new_from_array(arr)
+        resized = vimg.thumbnail_image(size[0], height=size[1], size='force').numpy()
+    else:
+        raise ValueError(f"Unknown resizer: {resizer}")
+    return Image.fromarray(resized, img.mode)
+
+
+def group_shared_outputs(
+    image_files: List[Tuple[Path, str, os.stat_result]]
+) -> List[List[Tuple[Path, str, os.stat_result]]]:
+    """
+    Group inputs that write the same outputs (same stem in the same directory,
+    e.g. X.png and X.webp both produce X.webp and X.avif), ordered by name within
+    each group
+    """
+    groups: Dict[Tuple[Path, str], List[Tuple[Path, str, os.stat_result]]] = {}
+    for image_file in image_files:
+        img_path = image_file[0]
+        groups.setdefault((img_path.parent, img_path.stem), []).append(image_file)
+    return [sorted(group, key=lambda x: x[1]) for group in groups.values()]
+
+
+def optimize_image_group(
+    input_paths: List[Path],
+    output_dir: Path,
+    formats: List[str] = None,
+    **options
+) -> List[List[OutputFile]]:
+    """
+    Optimize inputs that share outputs in a single worker
+    Each shared output is owned by the last input in the group that writes it, as
+    it was when every input was encoded in turn; earlier inputs only produce the
+    outputs no later input claims
+    Returns one optimize_image result list per input, in input order
+    """
+    if formats is None:
+        formats = DEFAULT_FORMATS
+    
+    # Inputs in a group share a directory, so outputs can be compared by file name alone
+    claimed: Set[Path] = set()
+    results = []
+    for input_path in reversed(input_paths):
+        output_formats = get_output_formats(Path(), Path(input_path.name), formats)
+        owned_formats = [fmt for output_path, fmt in output_formats.items() if output_path not in claimed]
+        claimed.update(output_formats)
+        results.append(optimize_image(input_path, output_dir, formats=owned_formats, **options))
+    results.reverse()
+    return results
+
+
+def init_worker(threads: int = 1):
+    """
+    Load Pillow codec plugins and warm up the JIT once per worker process
+    Caps each threaded backend at this worker's share of the cores
+    """
+    Image.init()
+    if CV2_SUPPORT:
+        cv2.setNumThreads(threads)
+    if VIPS_SUPPORT:
+        pyvips.vips_lib.vips_concurrency_set(threads)
+    if NUMBA_SUPPORT:
+        numba.set_num_threads(min(threads, numba.config.NUMBA_NUM_THREADS))
+        flatten_rgba_kernel(np.zeros((1, 1, 4), np.uint8), np.empty((1, 1, 3), np.uint8))
 
 
 def optimize_image(
@@ -38,67 +259,144 @@ def optimize_image(
     max_width: int = 2048,
     max_height: int = 2048,
     quality: int = 85,
-    formats: List[str] = None
-) -> List[Tuple[Path, int]]:
+    formats: List[str] = None,
+    avif_speed: int = 8,
+    threads: int = 1,
+    webp_method: Optional[int] = None,
+    resizer: str = 'pil',
+    force: bool = False
+) -> List[OutputFile]:
     """
-    Optimize a single image
-    Returns list of (output_path, file_size) tuples
+    Optimize a single image, skipping formats whose output is already up to date
+    threads is the number of cores this image's encoders may use
+    webp_method None means DEFAULT_WEBP_METHOD, or 6 for small images
+    Returns list of OutputFile tuples
     """
     if formats is None:
-        formats = ['webp', 'avif', 'original']
+        formats = DEFAULT_FORMATS
     
     results = []
     
     try:
-        # Open image
-        img = Image.open(input_path)
+        relative_path = input_path.relative_to(IMAGES_DIR)
+        file_output_dir = output_dir / relative_path.parent
+        params = {
+            'source': relative_path.as_posix(),
+            'quality': quality,
+            'max_width': max_width,
+            'max_height': max_height,
+            'avif_speed': avif_speed,
+            'webp_method': webp_method,
+            'resizer': resizer,
+        }
         
-        # Convert RGBA to RGB if needed for JPEG output
-        if img.mode in ('RGBA', 'LA', 'P'):
-            rgb_img = Image.new('RGB', img.size, (255, 255, 255))
-            rgb_img.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
-            img = rgb_img
+        output_formats = get_output_formats(file_output_dir, relative_path, formats)
         
-        # Calculate new dimensions while maintaining aspect ratio
-        width, height = img.size
-        if width > max_width or height > max_height:
-            ratio = min(max_width / width, max_height / height)
-            new_width = int(width * ratio)
-            new_height = int(height * ratio)
-            img = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
+        # Reuse outputs that are newer than the input and were encoded from it with the same params
+        pending_formats = []
+        input_stat = input_path.stat()
+        for output_path, fmt in output_formats.items():
+            cached_size = None
+            if not force:
+                cached_size = get_cached_size(output_path, input_stat.st_mtime, params)
+            if cached_size is None:
+                pending_formats.append(fmt)
+            else:
+                results.append(OutputFile(output_path, cached_size))
         
-        # Create output directory
-        relative_path = input_path.relative_to(IMAGES_DIR)
-        file_output_dir = output_dir / relative_path.parent
-        file_output_dir.mkdir(parents=True, exist_ok=True)
+        if not pending_formats:
+            return results
+        
+        # Open image, mapping large files so Pillow reads straight from the page cache
+        mm = None
+        if input_stat.st_size > MMAP_THRESHOLD:
+            with open(input_path, 'rb') as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            img = Image.open(mm)
+        else:
+            img = Image.open(input_path)
+        
+        try:
+            # Calculate new dimensions while maintaining aspect ratio
+            width, height = img.size
+            new_size = None
+            if width > max_width or height > max_height:
+                ratio = min(max_width / width, max_height / height)
+                new_size = (int(width * ratio), int(height * ratio))
+                if img.format == 'JPEG':
+                    # Let libjpeg decode at 1/2, 1/4 or 1/8 scale while still covering new_size
+                    img.draft(img.mode, new_size)
+            
+            img.load()
+        finally:
+            # The mapping must outlive decoding, which load() completes
+            if mm is not None:
+                mm.close()
+        
+        # Convert RGBA to RGB if needed for JPEG output; every format below
+        # encodes from this one decoded RGB buffer
+        if img.mode == 'RGBA':
+            img = flatten_alpha(img)
+        elif img.mode in ('LA', 'P'):
+            img = img.convert('RGB')
+        
+        if new_size and img.size != new_size:
+            img = resize_image(img, new_size, resizer)
+        
+        # Create output directory, once per directory per process
+        if file_output_dir not in CREATED_DIRS:
+            file_output_dir.mkdir(parents=True, exist_ok=True)
+            CREATED_DIRS.add(file_output_dir)
         
         # Save in different formats
         base_name = relative_path.stem
+        suffix = input_path.suffix.lower()
         
-        for fmt in formats:
+        def encode(fmt: str, src: Image.Image) -> Optional[OutputFile]:
+            output_path = get_output_path(fmt, file_output_dir, relative_path)
+            # Encode in memory, then write the whole file in one go
+            buf = io.BytesIO()
+            method = None
+            
             if fmt == 'webp':
-                output_path = file_output_dir / f"{base_name}.webp"
-                img.save(output_path, 'WEBP', quality=quality, method=6)
-                results.append((output_path, output_path.stat().st_size))
+                method = webp_method
+                if method is None:
+                    method = 6 if src.width * src.height <= SMALL_IMAGE_PIXELS else DEFAULT_WEBP_METHOD
+                src.save(buf, 'WEBP', quality=quality, method=method)
             
             elif fmt == 'avif':
-                if AVIF_SUPPORT:
-                    output_path = file_output_dir / f"{base_name}.avif"
-                    img.save(output_path, 'AVIF', quality=quality)
-                    results.append((output_path, output_path.stat().st_size))
-                else:
+                if not AVIF_SUPPORT:
                     click.echo(f"AVIF support not available, skipping {base_name}", err=True)
+                    return None
+                src.save(buf, 'AVIF', quality=quality, speed=avif_speed,
+                         subsampling='4:2:0', range='full', max_threads=threads)
             
             elif fmt == 'original':
                 # Save optimized version in original format
-                output_path = file_output_dir / relative_path.name
-                if input_path.suffix.lower() in ['.jpg', '.jpeg']:
-                    img.save(output_path, 'JPEG', quality=quality, optimize=True)
-                elif input_path.suffix.lower() == '.png':
-                    img.save(output_path, 'PNG', optimize=True)
+                if suffix in ['.jpg', '.jpeg']:
+                    src.save(buf, 'JPEG', quality=quality, optimize=True)
+                elif suffix == '.png':
+                    src.save(buf, 'PNG', optimize=True)
                 else:
-                    img.save(output_path)
-                results.append((output_path, output_path.stat().st_size))
+                    src.save(buf, Image.registered_extensions()[suffix])
+            
+            else:
+                return None
+            
+            size = write_file(output_path, buf.getbuffer())
+            write_meta(output_path, params)
+            return OutputFile(output_path, size, method)
+        
+        # Encoders release the GIL, so formats can be encoded concurrently when
+        # this worker has spare cores; Image.save stashes encoder options on the
+        # object, so each concurrent save gets its own copy of the image
+        if threads > 1 and len(pending_formats) > 1:
+            with ThreadPoolExecutor(max_workers=min(threads, len(pending_formats))) as executor:
+                futures = [executor.submit(encode, fmt, img.copy()) for fmt in pending_formats]
+                encoded = [f.result() for f in futures]
+        else:
+            encoded = [encode(fmt, img) for fmt in pending_formats]
+        results.extend(result for result in encoded if result is not None)
     
     except Exception as e:
         click.echo(f"Error processing {input_path}: {e}", err=True)
@@ -114,9 +412,19 @@ def optimize_image(
 @click.option('--max-width', default=2048, help='Maximum width in pixels')
 @click.option('--max-height', default=2048, help='Maximum height in pixels')
 @click.option('--quality', default=85, help='JPEG/WebP quality (1-100)')
-@click.option('--formats', multiple=True, default=['webp', 'avif', 'original'],
+@click.option('--formats', multiple=True, default=DEFAULT_FORMATS,
               help='Output formats (webp, avif, original)')
-def main(input_dir, output_dir, max_width, max_height, quality, formats):
+@click.option('--avif-speed', type=click.IntRange(0, 10), default=8,
+              help='AVIF encoder speed (0 = slowest/smallest, 10 = fastest)')
+@click.option('--webp-method', type=click.IntRange(0, 6), default=None,
+              help=f'WebP encoder method (0 = fastest, 6 = smallest); default {DEFAULT_WEBP_METHOD}, '
+                   f'or 6 for images up to {SMALL_IMAGE_PIXELS} pixels')
+@click.option('--resizer', type=click.Choice(list(RESIZERS)), default='pil',
+              help='Resize backend (cv2 and vips need opencv-python / pyvips installed)')
+@click.option('--force', is_flag=True, help='Re-encode images even if outputs are up to date')
+@click.option('--workers', type=click.IntRange(min=1), default=os.cpu_count(),
+              help='Number of worker processes (default: CPU count)')
+def main(input_dir, output_dir, max_width, max_height, quality, formats, avif_speed, webp_method, resizer, force, workers):
     """Optimize images for Web Speed Hackathon 2024"""
     
     # Set directories
@@ -127,6 +435,10 @@ def main(input_dir, output_dir, max_width, max_height, quality, formats):
         click.echo(f"Error: Input directory {images_dir} does not exist", err=True)
         sys.exit(1)
     
+    if not RESIZERS[resizer]:
+        click.echo(f"Error: Resizer {resizer} is not available", err=True)
+        sys.exit(1)
+    
     # Create output directory
     output_dir.mkdir(parents=True, exist_ok=True)
     
@@ -136,35 +448,70 @@ def main(input_dir, output_dir, max_width, max_height, quality, formats):
         click.echo("No image files found")
         return
     
+    # Inputs sharing outputs run in one task so they never write the same file at once;
+    # largest tasks first so long encodes don't end up alone at the tail of the pool
+    image_groups = group_shared_outputs(image_files)
+    image_groups.sort(key=lambda group: sum(st.st_size for _, _, st in group), reverse=True)
+    
     click.echo(f"Found {len(image_files)} images to optimize")
     click.echo(f"Output directory: {output_dir}")
     click.echo(f"Formats: {', '.join(formats)}")
+    if 'webp' in formats:
+        if webp_method is None:
+            click.echo(f"WebP method: {DEFAULT_WEBP_METHOD} (6 for images up to {SMALL_IMAGE_PIXELS} pixels)")
+        else:
+            click.echo(f"WebP method: {webp_method}")
+    click.echo(f"Resizer: {resizer}")
+    click.echo(f"Workers: {workers}")
     
-    # Process images
+    # Split encoder, resize, format and JIT threads across worker processes so cores aren't oversubscribed
+    worker_threads = max(1, (os.cpu_count() or 1) // workers)
+    
+    # Process images in parallel, one task per group of inputs
     total_original_size = 0
     total_optimized_size = 0
+    # WebP method -> [files, input bytes, output bytes] for files encoded this run
+    webp_stats: Dict[int, List[int]] = {}
     
-    with tqdm(image_files, desc="Optimizing images") as pbar:
-        for img_path in pbar:
-            pbar.set_description(f"Processing {img_path.name}")
-            
-            # Get original size
-            original_size = img_path.stat().st_size
-            total_original_size += original_size
-            
-            # Optimize image
-            results = optimize_image(
-                img_path, output_dir,
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(worker_threads,)) as executor:
+        futures = {
+            executor.submit(
+                optimize_image_group, [img_path for img_path, _, _ in group], output_dir,
                 max_width=max_width,
                 max_height=max_height,
                 quality=quality,
-                formats=list(formats)
-            )
-            
-            # Track optimized sizes
-            for output_path, size in results:
-                if output_path.suffix == img_path.suffix:
-                    total_optimized_size += size
+                formats=list(formats),
+                avif_speed=avif_speed,
+                threads=worker_threads,
+                webp_method=webp_method,
+                resizer=resizer,
+                force=force
+            ): group
+            for group in image_groups
+        }
+        
+        with tqdm(total=len(image_files), desc="Optimizing images") as pbar:
+            for i, future in enumerate(as_completed(futures)):
+                group = futures[future]
+                # Redrawing the description is a terminal write, so only do it periodically
+                if i % 100 == 0:
+                    pbar.set_description(f"Processed {group[0][1]}")
+                pbar.update(len(group))
+                
+                for (_, name, st), results in zip(group, future.result()):
+                    # Get original size
+                    total_original_size += st.st_size
+                    
+                    # Track optimized sizes (outputs in the original format keep the input's name)
+                    for output in results:
+                        if output.path.name == name:
+                            total_optimized_size += output.size
+                        if output.webp_method is not None:
+                            stats = webp_stats.setdefault(output.webp_method, [0, 0, 0])
+                            stats[0] += 1
+                            stats[1] += st.st_size
+                            stats[2] += output.size
     
     # Print summary
     click.echo("\n" + "="*50)
@@ -172,6 +519,9 @@ def main(input_dir, output_dir, max_width, max_height, quality, formats):
     click.echo(f"Total original size: {total_original_size / 1024 / 1024:.2f} MB")
     click.echo(f"Total optimized size: {total_optimized_size / 1024 / 1024:.2f} MB")
     click.echo(f"Size reduction: {(1 - total_optimized_size/total_original_size) * 100:.1f}%")
+    for method, (count, input_size, output_size) in sorted(webp_stats.items()):
+        click.echo(f"WebP method {method}: {count} files, "
+                   f"{(input_size - output_size) / 1024 / 1024:.2f} MB saved vs. inputs")
     click.echo(f"Output directory: {output_dir}")
 
 